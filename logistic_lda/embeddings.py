@@ -6,7 +6,8 @@ http://www.apache.org/licenses/LICENSE-2.0
 This module implements embeddings so they can be reused by different models.
 """
 
-import numpy as np
+from logistic_lda.utils import create_table
+
 import tensorflow as tf
 
 
@@ -24,10 +25,7 @@ def one_hot(features, meta_info, **kwargs):
   num_words = len(meta_info['words'])
 
   # maps words to indices
-  table = tf.contrib.lookup.HashTable(
-    tf.contrib.lookup.KeyValueTensorInitializer(
-      keys=meta_info['words'],
-      values=np.arange(num_words, dtype=np.int64)), -1)
+  table = create_table(meta_info['words'], name='word_table')
 
   # map words to indices, and indices to one-hot encoded embeddings
   features['embedding'] = tf.one_hot(table.lookup(features['word']), num_words)
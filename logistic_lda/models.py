@@ -6,12 +6,87 @@ http://www.apache.org/licenses/LICENSE-2.0
 Implementations of logistic LDA and baseline models for use with Tensorflow's Estimator.
 """
 
-from logistic_lda.utils import create_table, softmax_cross_entropy
+from logistic_lda.utils import RunBeforeSaveListener, RunEveryNStepsHook, fast_digamma
+from logistic_lda.utils import fast_softmax, jit_scope
+from logistic_lda.utils import lookup_indices, mixed_precision_scope, partitioned_scatter_add
+from logistic_lda.utils import softmax_cross_entropy
 
 import numpy as np
 import tensorflow as tf
 
 
+def _indices(features, name, keys):
+  """
+  Returns indices of `features[name]` among `keys`, or -1 where missing.
+
+  Indices computed by the input pipeline (see `create_datasets`) are used if available.
+  """
+
+  if name + '_idx' in features:
+    return features[name + '_idx']
+  return lookup_indices(keys, features[name])
+
+
+def _build_mlp(n_topics, params, kernel_regularizer=None):
+  """
+  Builds the network mapping embeddings to topic logits.
+
+  Layers keep the variable names of `tf.layers.dense`, so that checkpoints remain compatible.
+  With mixed precision, layers compute in float16 but the network returns float32 logits. The
+  network should then be called inside `mixed_precision_scope`.
+
+  Args:
+    n_topics: Number of outputs
+    params['hidden_units']: A list of integers describing the number of hidden units
+    params['mixed_precision']: If `True`, compute in float16 (optional)
+    kernel_regularizer: Regularizer applied to all weight matrices (optional)
+
+  Returns:
+    A `tf.keras.Sequential` model
+  """
+
+  mixed_precision = params.get('mixed_precision', False)
+  dtype = tf.float16 if mixed_precision else tf.float32
+
+  layers = [
+    tf.layers.Dense(units, activation=tf.nn.relu, kernel_regularizer=kernel_regularizer, dtype=dtype)
+    for units in params['hidden_units']]
+  layers.append(
+    tf.layers.Dense(n_topics, activation=None, kernel_regularizer=kernel_regularizer, dtype=dtype))
+
+  if mixed_precision:
+    layers.insert(0, tf.keras.layers.Lambda(lambda inputs: tf.cast(inputs, tf.float16)))
+    layers.append(tf.keras.layers.Lambda(lambda logits: tf.cast(logits, tf.float32)))
+
+  return tf.keras.Sequential(layers)
+
+
+def _create_optimizer(params):
+  """
+  Creates an Adam optimizer with exponentially decaying learning rate.
+
+  With mixed precision, the loss is scaled dynamically to prevent float16 gradients from
+  underflowing. The loss scale is stored in additional variables, so checkpoints of runs with
+  and without mixed precision only share weights (e.g., via `warm_start_from`).
+  """
+
+  optimizer = tf.train.AdamOptimizer(
+    learning_rate=tf.train.exponential_decay(
+      learning_rate=params['learning_rate'],
+      decay_rate=params['decay_rate'],
+      decay_steps=params['decay_steps'],
+      global_step=tf.train.get_global_step()))
+
+  if params.get('mixed_precision', False):
+    optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(
+      optimizer,
+      tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+        init_loss_scale=2 ** 15,
+        incr_every_n_steps=1000))
+
+  return optimizer
+
+
 def mlp(features, labels, mode, params):
   """
   Model function implementing a simple MLP which can be used for topic modeling.
@@ -28,6 +103,8 @@ def mlp(features, labels, mode, params):
     params['decay_rate']: Exponential learning rate decay parameter
     params['decay_steps']: Exponential learning rate decay parameter
     params['embedding']: A function which preprocesses features
+    params['xla']: If `True`, compile the forward pass and loss with XLA (optional)
+    params['mixed_precision']: If `True`, compute hidden layers in float16 (optional)
 
   Returns:
     A `tf.estimator.EstimatorSpec`
@@ -39,31 +116,25 @@ def mlp(features, labels, mode, params):
   features = params['embedding'](features)
 
   # convert string labels to integers
-  topic_table = create_table(params['meta_info']['topics'])
-  author_topics = topic_table.lookup(features['author_topic'])
-
-  net = features['embedding']
-  for units in params['hidden_units']:
-    net = tf.layers.dense(
-      net,
-      units=units,
-      activation=tf.nn.relu,
-      kernel_regularizer=tf.contrib.layers.l2_regularizer(params['model_regularization']))
-
-  logits = tf.layers.dense(
-    net,
+  author_topics = _indices(features, 'author_topic', params['meta_info']['topics'])
+
+  network = _build_mlp(
     n_topics,
-    activation=None,
+    params,
     kernel_regularizer=tf.contrib.layers.l2_regularizer(params['model_regularization']))
 
+  with jit_scope(params.get('xla', False)), mixed_precision_scope(params.get('mixed_precision', False)):
+    logits = network(features['embedding'])
+
   if mode == tf.estimator.ModeKeys.PREDICT:
-    probs = tf.reduce_max(tf.nn.softmax(logits), 1)
+    # probability of the most likely topic, computed without normalizing all probabilities
+    probs = tf.exp(tf.reduce_max(logits, 1) - tf.reduce_logsumexp(logits, 1))
     predictions = tf.argmax(logits, 1)
     predictions = {
       'item_id': features['item_id'],
       'item_prediction': predictions,
       'item_probability': probs,
-      'item_topic': topic_table.lookup(features['item_topic']),
+      'item_topic': _indices(features, 'item_topic', params['meta_info']['topics']),
       'author_id': features['author_id'],
       'author_prediction': predictions,
       'author_probability': probs,
@@ -72,11 +143,13 @@ def mlp(features, labels, mode, params):
 
     return tf.estimator.EstimatorSpec(mode, predictions=predictions)
 
-  # model is trained to predict which topic an author belongs to
-  loss = tf.reduce_mean(
-    softmax_cross_entropy(
-      targets=tf.one_hot(author_topics, depth=n_topics),
-      logits=logits))
+  # model is trained to predict which topic an author belongs to (unlabeled authors are ignored)
+  with jit_scope(params.get('xla', False)):
+    cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+      labels=tf.maximum(author_topics, 0),
+      logits=logits)
+    loss = tf.reduce_mean(
+      tf.where(author_topics < 0, tf.zeros_like(cross_entropy), cross_entropy))
 
   tf.summary.scalar('loss', loss)
 
@@ -88,12 +161,7 @@ def mlp(features, labels, mode, params):
     metric_ops = {'accuracy': (accuracy, acc_op)}
     return tf.estimator.EstimatorSpec(mode, loss=loss, eval_metric_ops=metric_ops)
 
-  optimizer = tf.train.AdamOptimizer(
-    learning_rate=tf.train.exponential_decay(
-      learning_rate=params['learning_rate'],
-      decay_rate=params['decay_rate'],
-      decay_steps=params['decay_steps'],
-      global_step=tf.train.get_global_step()))
+  optimizer = _create_optimizer(params)
   train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
 
   return tf.estimator.EstimatorSpec(
@@ -102,7 +170,7 @@ def mlp(features, labels, mode, params):
     train_op=train_op)
 
 
-def logistic_lda(features, labels, mode, params):
+def logistic_lda(features, labels, mode, params, config=None):
   """
   An implementation of logistic LDA.
 
@@ -126,6 +194,12 @@ def logistic_lda(features, labels, mode, params):
     params['items_per_author']: For simplicity, model assumes this many items per author
     params['alpha']: Smoothes topic distributions of authors
     params['embedding']: A function which preprocesses features
+    params['xla']: If `True`, compile the forward pass and loss with XLA (optional)
+    params['mixed_precision']: If `True`, compute hidden layers in float16 (optional)
+    params['topic_dist_update_steps']: Apply updates of the topic distribution estimate only
+      every this many steps (optional)
+    params['topic_counts_shards']: Split topic counts into this many variables (optional)
+    config: Estimator's `RunConfig` (optional)
   """
 
   if params['author_topic_iterations'] < 1:
@@ -135,40 +209,36 @@ def logistic_lda(features, labels, mode, params):
   n_topics = len(params['meta_info']['topics'])
 
   with tf.name_scope('preprocessing'):
-    # lookup table which maps topics to indices and missing topics to -1
-    topic_table = create_table(
-      keys=params['meta_info']['topics'] + [''],
-      values=list(range(n_topics)) + [-1],
-      name='topic_table')
-
-    # convert string labels to integers
-    author_topics = topic_table.lookup(features['author_topic'])
-    item_topics = topic_table.lookup(features['item_topic'])
+    # convert string labels to integers, mapping missing topics to -1
+    author_topics = _indices(features, 'author_topic', params['meta_info']['topics'])
+    item_topics = _indices(features, 'item_topic', params['meta_info']['topics'])
 
     # convert author IDs to low integers
-    author_table = create_table(
-      keys=np.asarray(params['meta_info']['author_ids'], dtype=np.int64),
-      name='author_table')
-    author_ids = tf.squeeze(author_table.lookup(features['author_id']))
+    author_ids = tf.squeeze(_indices(
+      features, 'author_id', np.asarray(params['meta_info']['author_ids'], dtype=np.int64)))
 
   # preprocess features (e.g., compute embeddings from words)
   with tf.name_scope('embedding'):
     features = params['embedding'](features)
 
+  use_xla = params.get('xla', False)
+
   # predict topics from items
-  net = features['embedding']
-  for units in params['hidden_units']:
-    net = tf.layers.dense(net, units=units, activation=tf.nn.relu)
+  with jit_scope(use_xla), mixed_precision_scope(params.get('mixed_precision', False)):
+    logits = _build_mlp(n_topics, params)(features['embedding'])  # BxK
 
   with tf.name_scope('variational_inference'):
-    # keeps track of topic counts per user
+    topic_counts_shards = params.get('topic_counts_shards', 1)
+
+    # keeps track of topic counts per user, optionally sharded across parameter servers
     topic_counts_var = tf.get_variable(
       'topic_counts',
       shape=[n_authors, n_topics],
       dtype=tf.float32,
       initializer=tf.ones_initializer,
       trainable=False,
-      use_resource=True)
+      use_resource=True,
+      partitioner=tf.fixed_size_partitioner(topic_counts_shards) if topic_counts_shards > 1 else None)
 
     # keeps track of predicted topic distributions across all items
     topic_dist_total_var = tf.get_variable(
@@ -178,43 +248,67 @@ def logistic_lda(features, labels, mode, params):
       trainable=False,
       use_resource=True)
 
-    # expected topic counts for each author
-    topic_counts = tf.gather(topic_counts_var, author_ids)
+    with jit_scope(use_xla):
+      # expected topic counts for each author
+      topic_counts = tf.nn.embedding_lookup(topic_counts_var, author_ids, partition_strategy='div')
+
+      # part of the author's Dirichlet parameters which stays fixed during inference
+      author_alpha_prior = params['alpha'] + topic_counts
+
+      def _update_beliefs(author_topics_prediction, author_alpha, topic_biases):
+        # update beliefs over author's topic distribution
+        author_alpha = author_alpha_prior + params['author_topic_weight'] * author_topics_prediction
+        topic_biases = fast_digamma(author_alpha)
 
-    author_topics_onehot = tf.one_hot(tf.squeeze(author_topics), n_topics)
-    author_topics_prediction = tf.ones_like(author_topics_onehot) / n_topics
+        # update predictions of author topics
+        author_topics_prediction = fast_softmax(params['author_topic_weight'] * topic_biases)
 
-    # infer missing author topics
-    for _ in range(params['author_topic_iterations']):
-      if params['use_author_topics']:
+        return author_topics_prediction, author_alpha, topic_biases
+
+      def _update_beliefs_with_labels(author_topics_prediction, author_alpha, topic_biases):
         # where available, use ground truth instead of predictions
         author_topics_prediction = tf.where(
-          author_topics < 0,
+          author_topics_missing,
           author_topics_prediction,
           author_topics_onehot)
 
-      # update beliefs over author's topic distribution
-      author_alpha = params['alpha'] + topic_counts + params['author_topic_weight'] * author_topics_prediction
-      topic_biases = tf.digamma(author_alpha)
-
-      # update predictions of author topics
-      author_topics_prediction = tf.nn.softmax(params['author_topic_weight'] * topic_biases)
-
-    logits = tf.layers.dense(net, n_topics, activation=None)  # BxK
-    logits_biased = logits + topic_biases
-
-    # probability of each topic
-    probs = tf.nn.softmax(logits)
-    probs_biased = tf.nn.softmax(logits_biased)
+        return _update_beliefs(author_topics_prediction, author_alpha, topic_biases)
 
-    if mode == tf.estimator.ModeKeys.PREDICT:
       if params['author_topic_weight'] < 1e-8:
-        author_topics_prediction = tf.nn.softmax(1e-8 * topic_biases)
+        # author topics have no influence on beliefs, so inference converges immediately
+        author_alpha = author_alpha_prior
+        topic_biases = fast_digamma(author_alpha)
+        author_topics_prediction = fast_softmax(1e-8 * topic_biases)
+
+      elif params['author_topic_iterations'] == 1 and not params['use_author_topics']:
+        # a single iteration starting from uniform predictions needs neither a loop nor labels
+        author_alpha = author_alpha_prior + params['author_topic_weight'] / n_topics
+        topic_biases = fast_digamma(author_alpha)
+        author_topics_prediction = fast_softmax(params['author_topic_weight'] * topic_biases)
+
+      else:
+        if params['use_author_topics']:
+          author_topics_onehot = tf.one_hot(author_topics, n_topics)
+          author_topics_missing = author_topics < 0
+
+        # infer missing author topics
+        author_topics_prediction, author_alpha, topic_biases = tf.while_loop(
+          cond=lambda *_: True,
+          body=_update_beliefs_with_labels if params['use_author_topics'] else _update_beliefs,
+          loop_vars=[
+            tf.ones_like(topic_counts) / n_topics,
+            tf.zeros_like(topic_counts),
+            tf.zeros_like(topic_counts)],
+          maximum_iterations=int(params['author_topic_iterations']))
+
+      logits_biased = logits + topic_biases
 
+    if mode == tf.estimator.ModeKeys.PREDICT:
       predictions = {
         'item_id': features.get('item_id', tf.zeros_like(author_ids) - 1),
         'item_prediction': tf.argmax(logits_biased, 1),
-        'item_probability': tf.reduce_max(probs_biased, 1),
+        'item_probability': tf.exp(
+          tf.reduce_max(logits_biased, 1) - tf.reduce_logsumexp(logits_biased, 1)),
         'item_topic': item_topics,
         'author_id': author_ids,
         'author_prediction': tf.argmax(author_topics_prediction, 1),
@@ -223,36 +317,42 @@ def logistic_lda(features, labels, mode, params):
       }
       return tf.estimator.EstimatorSpec(mode, predictions=predictions)
 
-    # model is regularized to predict these topics
-    expected_topics = (probs + 1e-6) / (topic_dist_total_var + 1e-6) / n_topics
+    with jit_scope(use_xla):
+      # probability of each topic
+      probs = tf.nn.softmax(logits)
+      logprobs_biased = tf.nn.log_softmax(logits_biased)
+      probs_biased = tf.exp(logprobs_biased)
 
-    # the unbiased model tries to predict the biased topics
-    loss = tf.reduce_mean(
-      softmax_cross_entropy(
-        targets=tf.stop_gradient(probs_biased + params['model_regularization'] * expected_topics),
-        logits=logits))
+      # model is regularized to predict these topics (normalization is computed once for all items)
+      topic_dist_normalizer = tf.reciprocal((topic_dist_total_var + 1e-6) * n_topics)  # 1xK
+      expected_topics = (probs + 1e-6) * topic_dist_normalizer
+
+      # the unbiased model tries to predict the biased topics
+      loss = tf.reduce_mean(
+        softmax_cross_entropy(
+          targets=tf.stop_gradient(probs_biased + params['model_regularization'] * expected_topics),
+          logits=logits))
 
-    tf.summary.scalar('cross_entropy', loss)
+      tf.summary.scalar('cross_entropy', loss)
 
-    # compute upper bound on the KL divergence (up to a constant)
-    with tf.name_scope('upper_bound'):
-      dirichlet_entropy = tf.distributions.Dirichlet(author_alpha).entropy()
-      dirichlet_entropy = tf.reduce_mean(dirichlet_entropy) / params['items_per_author']
+      # compute upper bound on the KL divergence (up to a constant)
+      with tf.name_scope('upper_bound'):
+        dirichlet_entropy = tf.distributions.Dirichlet(author_alpha).entropy()
+        dirichlet_entropy = tf.reduce_mean(dirichlet_entropy) / params['items_per_author']
 
-      dirichlet_regularizer = (params['alpha'] - 1.0) * tf.reduce_sum(topic_biases, axis=1)
-      dirichlet_regularizer = tf.reduce_mean(dirichlet_regularizer) / params['items_per_author']
+        dirichlet_regularizer = (params['alpha'] - 1.0) * tf.reduce_sum(topic_biases, axis=1)
+        dirichlet_regularizer = tf.reduce_mean(dirichlet_regularizer) / params['items_per_author']
 
-      regularizer_entropy = tf.reduce_sum(expected_topics * tf.log(expected_topics), axis=1)
-      regularizer_entropy = -tf.reduce_mean(regularizer_entropy) * params['model_regularization']
+        regularizer_entropy = tf.reduce_sum(expected_topics * tf.log(expected_topics), axis=1)
+        regularizer_entropy = -tf.reduce_mean(regularizer_entropy) * params['model_regularization']
 
-      logprobs_biased = logits_biased - tf.reduce_logsumexp(logits_biased, axis=1, keepdims=True)
-      topic_entropy_plus = tf.reduce_sum(probs_biased * (logprobs_biased - topic_biases), axis=1)
-      topic_entropy_plus = -tf.reduce_mean(topic_entropy_plus)
+        topic_entropy_plus = tf.reduce_sum(probs_biased * (logprobs_biased - topic_biases), axis=1)
+        topic_entropy_plus = -tf.reduce_mean(topic_entropy_plus)
 
-      loss = loss - tf.stop_gradient(
-        dirichlet_regularizer + dirichlet_entropy + topic_entropy_plus + regularizer_entropy)
+        loss = loss - tf.stop_gradient(
+          dirichlet_regularizer + dirichlet_entropy + topic_entropy_plus + regularizer_entropy)
 
-      tf.summary.scalar('upper_bound', loss)
+        tf.summary.scalar('upper_bound', loss)
 
     if mode == tf.estimator.ModeKeys.EVAL:
       # this assumes that all authors/items are labeled
@@ -272,19 +372,61 @@ def logistic_lda(features, labels, mode, params):
 
     # update topic counters
     topic_counts_diff = probs_biased - topic_counts / params['items_per_author']
-    topic_counts_update = tf.scatter_add(topic_counts_var, author_ids, topic_counts_diff)
+
+    # combine updates of authors appearing multiple times in the batch to scatter each row once
+    unique_author_ids, unique_idx = tf.unique(tf.reshape(author_ids, [-1]))
+    topic_counts_diff = tf.unsorted_segment_sum(
+      topic_counts_diff, unique_idx, tf.size(unique_author_ids))
+
+    topic_counts_update = partitioned_scatter_add(
+      list(topic_counts_var) if topic_counts_shards > 1 else [topic_counts_var],
+      unique_author_ids,
+      topic_counts_diff)
 
     # update distribution of predicted topics
     topic_dist_diff = (probs - topic_dist_total_var) / (params['items_per_author'] * n_authors)
-    topic_dist_total_update = tf.assign_add(
-      topic_dist_total_var, tf.reduce_sum(topic_dist_diff, axis=0, keepdims=True))
-
-    optimizer = tf.train.AdamOptimizer(
-      learning_rate=tf.train.exponential_decay(
-        learning_rate=params['learning_rate'],
-        decay_rate=params['decay_rate'],
-        decay_steps=params['decay_steps'],
-        global_step=tf.train.get_global_step()))
+    topic_dist_diff = tf.reduce_sum(topic_dist_diff, axis=0, keepdims=True)
+
+    training_hooks = []
+    training_chief_hooks = []
+    topic_dist_update_steps = params.get('topic_dist_update_steps', 1)
+
+    if topic_dist_update_steps > 1:
+      # keep the staging buffer on this worker even if variables are placed on parameter servers
+      worker_device = None
+      if config is not None and config.cluster_spec:
+        worker_device = '/job:{}/task:{}'.format(config.task_type, config.task_id)
+
+      # collect updates in a local staging buffer which is only applied every few steps
+      with tf.device(lambda op: worker_device or op.device):
+        topic_dist_staged_var = tf.get_variable(
+          'topic_dist_staged',
+          shape=[1, n_topics],
+          initializer=tf.zeros_initializer,
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES],
+          use_resource=True)
+      topic_dist_total_update = tf.assign_add(topic_dist_staged_var, topic_dist_diff)
+
+      # move staged updates to the total, keeping updates which arrive while flushing
+      topic_dist_staged = topic_dist_staged_var.read_value()
+      with tf.control_dependencies([tf.assign_add(topic_dist_total_var, topic_dist_staged)]):
+        topic_dist_flush = tf.assign_sub(topic_dist_staged_var, topic_dist_staged)
+
+      training_hooks.append(RunEveryNStepsHook(topic_dist_flush, topic_dist_update_steps))
+
+      if config is not None and (config.save_checkpoints_steps or config.save_checkpoints_secs):
+        # apply staged updates before each checkpoint (this replaces Estimator's default saver)
+        training_chief_hooks.append(tf.train.CheckpointSaverHook(
+          config.model_dir,
+          save_secs=config.save_checkpoints_secs,
+          save_steps=config.save_checkpoints_steps,
+          listeners=[RunBeforeSaveListener(topic_dist_flush)]))
+
+    else:
+      topic_dist_total_update = tf.assign_add(topic_dist_total_var, topic_dist_diff)
+
+    optimizer = _create_optimizer(params)
     train_op = optimizer.minimize(loss, global_step=tf.train.get_global_step())
 
     # update model parameters, topic counts, and topic distribution estimate
@@ -293,4 +435,6 @@ def logistic_lda(features, labels, mode, params):
   return tf.estimator.EstimatorSpec(
     mode,
     loss=loss,
-    train_op=train_op)
+    train_op=train_op,
+    training_hooks=training_hooks,
+    training_chief_hooks=training_chief_hooks)
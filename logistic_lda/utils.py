@@ -4,6 +4,8 @@ Licensed under the Apache License, Version 2.0
 http://www.apache.org/licenses/LICENSE-2.0
 """
 
+from contextlib import contextmanager
+
 import numpy as np
 import tensorflow as tf
 
@@ -17,6 +19,9 @@ def softmax_cross_entropy(targets, logits):
   Targets can be arbitrary vectors and do not have to be one-hot encodings or normalized,
   unlike in some other implementations of cross-entropy.
 
+  The computation is delegated to Tensorflow's fused kernel. Since its gradient assumes normalized
+  targets, targets are normalized first and the result is rescaled.
+
   Args:
     targets: A float tensor of shape [B, K]
     logits: A float tensor of shape [B, K]
@@ -25,8 +30,102 @@ def softmax_cross_entropy(targets, logits):
     A float tensor of shape [B]
   """
 
-  logprobs = logits - tf.reduce_logsumexp(logits, axis=1, keepdims=True)
-  return -tf.reduce_sum(targets * logprobs, axis=1)
+  normalizer = tf.reduce_sum(targets, axis=1)
+  cross_entropy = tf.nn.softmax_cross_entropy_with_logits_v2(
+    labels=targets / tf.maximum(tf.expand_dims(normalizer, 1), 1e-20),
+    logits=logits)
+  return normalizer * cross_entropy
+
+
+def fast_softmax(logits):
+  """
+  Computes a softmax over the last axis of a 2D tensor.
+
+  Unlike `tf.nn.softmax`, the computation is spelled out using reductions which keep dimensions,
+  so that it can be fused into a single kernel by XLA.
+
+  Args:
+    logits: A float tensor of shape [B, K]
+
+  Returns:
+    A float tensor of shape [B, K]
+  """
+
+  exp_logits = tf.exp(logits - tf.reduce_max(logits, axis=1, keepdims=True))
+  return exp_logits / tf.reduce_sum(exp_logits, axis=1, keepdims=True)
+
+
+def fast_digamma(x):
+  """
+  Computes the digamma function for positive inputs.
+
+  Uses the recurrence $\psi(x) = \psi(x + 6) - \sum_{k=0}^{5} 1 / (x + k)$ followed by the
+  asymptotic expansion of $\psi(x + 6)$. Unlike `tf.digamma`, this avoids data-dependent loops
+  and branches, and only needs a single logarithm. The absolute error of the approximation is
+  about 3e-9, not counting floating point rounding. Since the recurrence sums reciprocals, the
+  rounding error in float32 grows for inputs close to zero (e.g., about 1e-3 for x = 2e-4).
+
+  Args:
+    x: A float tensor with positive entries
+
+  Returns:
+    A float tensor of the same shape as `x`
+  """
+
+  shift = 1.0 / x
+  for k in range(1, 6):
+    shift += 1.0 / (x + k)
+
+  y = x + 6.0
+  y_inv_sq = 1.0 / (y * y)
+  series = y_inv_sq * (1.0 / 12.0 - y_inv_sq * (1.0 / 120.0 - y_inv_sq / 252.0))
+
+  return tf.log(y) - 0.5 / y - series - shift
+
+
+def lookup_indices(keys, values):
+  """
+  Maps values to the indices of the corresponding keys without using a hash table.
+
+  Values which are not among the keys are mapped to -1. Since no table has to be initialized, this
+  can be used inside `tf.data` pipelines with one-shot iterators. String keys are compared to all
+  values, which is only efficient for small sets of keys. Numeric keys are found using binary
+  search, unless they form the range 0, 1, 2, ... in which case values are their own indices.
+
+  Args:
+    keys: A list of strings or integers
+    values: A tensor of strings or integers
+
+  Returns:
+    An int64 tensor with the same shape as `values`
+  """
+
+  keys = np.asarray(keys)
+
+  if keys.dtype.kind in 'OSU':
+    matches = tf.equal(tf.expand_dims(values, -1), keys.tolist())
+    indices = tf.argmax(tf.cast(matches, tf.int32), axis=-1)
+    return tf.where(tf.reduce_any(matches, axis=-1), indices, -tf.ones_like(indices))
+
+  if np.array_equal(keys, np.arange(len(keys))):
+    indices = tf.cast(values, tf.int64)
+    return tf.where(
+      tf.logical_and(indices >= 0, indices < len(keys)),
+      indices,
+      -tf.ones_like(indices))
+
+  order = np.argsort(keys, kind='mergesort')
+  sorted_keys = tf.constant(keys[order], dtype=values.dtype)
+
+  flat_values = tf.reshape(values, [-1])
+  positions = tf.minimum(tf.searchsorted(sorted_keys, flat_values), len(keys) - 1)
+  indices = tf.gather(tf.constant(order, dtype=tf.int64), positions)
+  indices = tf.where(
+    tf.equal(tf.gather(sorted_keys, positions), flat_values),
+    indices,
+    -tf.ones_like(indices))
+
+  return tf.reshape(indices, tf.shape(values))
 
 
 def create_table(keys, values=None, name=None):
@@ -47,3 +146,148 @@ def create_table(keys, values=None, name=None):
 
   return tf.contrib.lookup.HashTable(
     tf.contrib.lookup.KeyValueTensorInitializer(keys=keys, values=values), -1, name=name)
+
+
+def partitioned_scatter_add(partitions, indices, updates):
+  """
+  Adds updates to rows of a variable which is split along its first axis.
+
+  This is the counterpart of `tf.nn.embedding_lookup` with `partition_strategy='div'` and can be
+  used with the variables of a `PartitionedVariable` created by `tf.fixed_size_partitioner`.
+  Each partition is only updated with the rows it contains, so updates happen on the device
+  holding the partition.
+
+  Args:
+    partitions: A list of variables which concatenated form the full variable
+    indices: An integer tensor of shape [B] indexing rows of the full variable
+    updates: A tensor of shape [B, ...]
+
+  Returns:
+    An operation performing all updates
+  """
+
+  if len(partitions) == 1:
+    return tf.scatter_add(partitions[0], indices, updates)
+
+  update_ops = []
+  offset = 0
+
+  for partition in partitions:
+    size = partition.get_shape()[0].value
+    mask = tf.logical_and(indices >= offset, indices < offset + size)
+    update_ops.append(tf.scatter_add(
+      partition,
+      tf.boolean_mask(indices, mask) - offset,
+      tf.boolean_mask(updates, mask)))
+    offset += size
+
+  return tf.group(*update_ops)
+
+
+def _uncompiled_variable_getter(getter, *args, **kwargs):
+  """
+  Creates variables and their initializers without marking them for XLA compilation.
+  """
+
+  with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=False):
+    return getter(*args, **kwargs)
+
+
+@contextmanager
+def jit_scope(enabled=True):
+  """
+  Marks operations created inside this context for XLA compilation.
+
+  Neighboring operations marked this way are compiled into fused kernels, which avoids writing
+  intermediate results of elementwise operations and reductions to memory. Variables created
+  inside this context (e.g., by layers called for the first time) and their initializers are
+  not marked.
+
+  Args:
+    enabled: If `False`, operations are left untouched
+  """
+
+  if enabled:
+    with tf.contrib.compiler.jit.experimental_jit_scope():
+      with tf.variable_scope(tf.get_variable_scope(), custom_getter=_uncompiled_variable_getter):
+        yield
+  else:
+    yield
+
+
+def _float32_variable_getter(getter, *args, **kwargs):
+  """
+  Creates float32 variables in place of float16 variables and casts them to float16.
+  """
+
+  dtype = kwargs.get('dtype')
+  if dtype == tf.float16:
+    kwargs['dtype'] = tf.float32
+
+  variable = getter(*args, **kwargs)
+
+  if dtype == tf.float16:
+    variable = tf.cast(variable, tf.float16)
+
+  return variable
+
+
+@contextmanager
+def mixed_precision_scope(enabled=True):
+  """
+  Keeps float16 variables created inside this context in float32.
+
+  Layers can compute in float16 while their weights are stored and updated in float32, so that
+  small updates of the weights are not lost.
+
+  Args:
+    enabled: If `False`, variables are left untouched
+  """
+
+  if enabled:
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=_float32_variable_getter):
+      yield
+  else:
+    yield
+
+
+class RunEveryNStepsHook(tf.train.SessionRunHook):
+  """
+  Runs an operation after every `every_n_steps` training steps and once more at the end.
+
+  On the chief, chief-only hooks such as `CheckpointSaverHook` end first, so the final run
+  happens after the last checkpoint has been written. Use `RunBeforeSaveListener` to also run
+  the operation before checkpoints are saved.
+
+  Args:
+    op: The operation to run
+    every_n_steps: Number of steps between runs
+  """
+
+  def __init__(self, op, every_n_steps):
+    self._op = op
+    self._every_n_steps = every_n_steps
+    self._steps = 0
+
+  def after_run(self, run_context, run_values):
+    self._steps += 1
+    if self._steps % self._every_n_steps == 0:
+      run_context.session.run(self._op)
+
+  def end(self, session):
+    session.run(self._op)
+
+
+class RunBeforeSaveListener(tf.train.CheckpointSaverListener):
+  """
+  Runs an operation before each checkpoint is saved.
+
+  Args:
+    op: The operation to run
+  """
+
+  def __init__(self, op):
+    self._op = op
+
+  def before_save(self, session, global_step_value):
+    session.run(self._op)
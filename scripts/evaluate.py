@@ -48,6 +48,8 @@ def main(args):
         'meta_info': meta_info,
         'embedding': embedding,
         'use_author_topics': False,
+        'xla': args.xla,
+        'mixed_precision': args.mixed_precision,
       },
       warm_start_from=args.model_dir,
     )
@@ -69,6 +71,8 @@ def main(args):
         'meta_info': meta_info,
         'embedding': embedding,
         'use_author_topics': False,
+        'xla': args.xla,
+        'mixed_precision': args.mixed_precision,
       },
       model_dir=classifier.model_dir,
     )
@@ -198,6 +202,11 @@ if __name__ == '__main__':
       help='Which embedding function to apply to data points in the training set')
   parser.add_argument('--cache', action='store_true',
       help='Cache data for faster iterations')
+  parser.add_argument('--xla', action='store_true',
+      help='Compile the forward pass and loss with XLA')
+  parser.add_argument('--mixed_precision', action='store_true',
+      help='Compute hidden layers in float16 while keeping weights in float32 '
+           '(adds loss scale variables, so do not toggle when resuming from a checkpoint)')
 
   args = parser.parse_args()
 
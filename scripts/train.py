@@ -39,6 +39,10 @@ def main(args):
       'meta_info': meta_info,
       'embedding': partial(getattr(embeddings, args.embedding), meta_info=meta_info, args=args, mode='train'),
       'use_author_topics': True,
+      'xla': args.xla,
+      'topic_dist_update_steps': args.topic_dist_update_steps,
+      'topic_counts_shards': args.topic_counts_shards,
+      'mixed_precision': args.mixed_precision,
     },
     model_dir=args.model_dir,
     warm_start_from=args.warm_start_from)
@@ -63,7 +67,7 @@ if __name__ == '__main__':
       help='Number of items per training batch')
   parser.add_argument('--author_topic_weight', type=float, default=200,
       help='Strength of factor connecting author labels with topic proportions')
-  parser.add_argument('--author_topic_iterations', type=float, default=1,
+  parser.add_argument('--author_topic_iterations', type=int, default=1,
       help='Number of variational inference iterations to infer missing author labels')
   parser.add_argument('--topic_bias_regularization', type=float, default=0.5,
       help='Parameter of Dirichlet prior on topic proportions')
@@ -99,6 +103,15 @@ if __name__ == '__main__':
       help='Initialize parameters from this model')
   parser.add_argument('--cache', action='store_true',
       help='Cache data to speed up subsequent training epochs')
+  parser.add_argument('--xla', action='store_true',
+      help='Compile the forward pass and loss with XLA')
+  parser.add_argument('--mixed_precision', action='store_true',
+      help='Compute hidden layers in float16 while keeping weights in float32 '
+           '(adds loss scale variables, so do not toggle when resuming from a checkpoint)')
+  parser.add_argument('--topic_dist_update_steps', type=int, default=1,
+      help='Collect updates of the topic distribution estimate and apply them every this many steps')
+  parser.add_argument('--topic_counts_shards', type=int, default=1,
+      help='Split topic counts per author into this many variables, e.g., to spread them across servers')
 
   args, _ = parser.parse_known_args()
 